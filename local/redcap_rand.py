@@ -2,11 +2,19 @@ import requests
 import config
 import pandas as pd
 import numpy as np
-import random
 import json
+import pickle
+import orjson
 import sys
+import os
+import time
+import hashlib
+import functools
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Operational variables
 redcap_api_token = config.redcap_api_token
@@ -15,6 +23,11 @@ redcap_endpoint = config.redcap_endpoint
 allocation_tablename = config.allocation_table
 treatment_field = config.treatment_field
 randomized_field = config.randomized_field
+cache_directory = './cache/'
+allocation_filename = './data/' + allocation_tablename
+probability_state_filename = cache_directory + 'probstate.pkl'
+codebook_cache_ttl = 3600 # Seconds before a cached REDCap codebook is fetched again
+rng = np.random.default_rng() # Random generator used to assign treatments
 log_filename = './logs/redcap_rand_log_' + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + '.log'
 logging.basicConfig(
     filename=log_filename,
@@ -24,6 +37,14 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
+# Shared HTTP session so REDCap API calls reuse pooled keep-alive connections
+request_timeout = (5, 60) # Seconds to wait for (connect, read) on REDCap API calls
+import_timeout = (5, 600) # Record imports can take much longer for REDCap to process
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3))
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
 def pull_redcap_report():
     data = {
         'token': redcap_api_token,
@@ -36,7 +57,13 @@ def pull_redcap_report():
         'exportCheckboxLabel': 'false',
         'returnFormat': 'json',
     }
-    response = requests.post(url = redcap_endpoint, data = data)
+    try:
+        response = session.post(url = redcap_endpoint, data = data, timeout = request_timeout)
+    except Exception as e:
+        print("Failed to fetch REDCap report. Exiting.")
+        logging.info("Failed to fetch REDCap report. Exiting.")
+        logging.info(e)
+        sys.exit(1)
     if response.status_code == 200:
         print('HTTP Status', str(response.status_code), response.reason, ": Records download successful")
         logging.info('HTTP Status:' + str(response.status_code) + ' ' + response.reason + ": Records download successful")
@@ -44,12 +71,57 @@ def pull_redcap_report():
         print('HTTP Status', str(response.status_code), response.reason, ": Records failed to download")
         logging.info('HTTP Status:' + str(response.status_code) + ' ' + response.reason + ": Records failed to download")
         sys.exit(1)
-    if len(response.json()) == 0:
+    eligibility_report = orjson.loads(response.content)
+    if len(eligibility_report) == 0:
         print("No eligible records in REDCap")
         logging.info("No eligible records in REDCap")
         sys.exit(1)
-    return response.json()
+    return eligibility_report
+
+def write_cache_file(cache_filename, content):
+    # Write to a temporary file first so an interrupted run never leaves a partial cache
+    os.makedirs(cache_directory, exist_ok=True)
+    temp_filename = cache_filename + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(content)
+    os.replace(temp_filename, cache_filename)
+
+def is_codebook(payload):
+    # A usable codebook is a list of field dicts.  REDCap reports errors as a
+    # single dict, e.g. {'error': '...'}, which must never be cached.
+    return isinstance(payload, list) and all(isinstance(field, dict) and 'field_name' in field for field in payload)
 
+def cache_codebook(func):
+    # The project codebook rarely changes between runs, so keep a copy on disk keyed
+    # by endpoint and project token.  A cached copy younger than codebook_cache_ttl
+    # is returned instead of fetching the codebook from REDCap again.
+    @functools.wraps(func)
+    def wrapper():
+        key = hashlib.sha1((redcap_endpoint + redcap_api_token).encode('utf-8')).hexdigest()
+        cache_filename = cache_directory + 'codebook_' + key + '.json'
+        try:
+            if time.time() - os.path.getmtime(cache_filename) < codebook_cache_ttl:
+                with open(cache_filename, 'r', encoding='utf-8') as f:
+                    codebook = json.load(f)
+                if is_codebook(codebook):
+                    print("Loaded REDCap codebook from cache")
+                    logging.info("Loaded project codebook from cache " + cache_filename)
+                    return codebook
+                logging.info("Ignoring invalid cached project codebook " + cache_filename)
+        except (OSError, ValueError):
+            pass
+        codebook = func()
+        if is_codebook(codebook):
+            try:
+                write_cache_file(cache_filename, json.dumps(codebook).encode('utf-8'))
+            except Exception as e:
+                logging.info("Failed to cache project codebook")
+                logging.info(e)
+        return codebook
+    return wrapper
+
+@functools.lru_cache(maxsize=1)
+@cache_codebook
 def pull_redcap_codebook():
     data = {
         'token': redcap_api_token,
@@ -58,59 +130,73 @@ def pull_redcap_codebook():
         'returnFormat': 'json'
     }
     try:
-        response = requests.post(redcap_endpoint, data = data)
-        print("Successfully fetched REDCap codebook")
-        logging.info("Successfully fetched project codebook")
+        response = session.post(redcap_endpoint, data = data, timeout = request_timeout)
     except Exception as e:
         print("Failed to fetch REDCap codebook. Exiting.")
         logging.info("Failed to fetch project codebook. Exiting.")
         logging.info(e)
         sys.exit(1)
-    return response.json()
+    if response.status_code == 200:
+        print('HTTP Status', str(response.status_code), response.reason, ": Successfully fetched REDCap codebook")
+        logging.info('HTTP Status:' + str(response.status_code) + ' ' + response.reason + ": Successfully fetched project codebook")
+    else:
+        print('HTTP Status', str(response.status_code), response.reason, ": Failed to fetch REDCap codebook. Exiting.")
+        logging.info('HTTP Status:' + str(response.status_code) + ' ' + response.reason + ": Failed to fetch project codebook. Exiting.")
+        logging.info(response.text)
+        sys.exit(1)
+    codebook = orjson.loads(response.content)
+    if not is_codebook(codebook):
+        print("REDCap returned an invalid codebook. Exiting.")
+        logging.info("REDCap returned an invalid codebook. Exiting.")
+        logging.info(codebook)
+        sys.exit(1)
+    return codebook
 
 def convert_codebook(full_codebook, criteria):
     codebook = {}
     # Create translation dictionary of {field_name: {label1: value1, label2: value2, etc}} from full_codebook
-    for obj in full_codebook:
-        # Check to make sure all criteria have label:value options.
-        # Current supported field types include Multiple Choice (dropdown),  Multiple Choice (radio),
-        # Checkboxes, Yes-No, and True-False.  Yes-No and True-False values are calculated within the code
-        approved_field_types = ['dropdown', 'radio', 'checkbox']
-        if obj['field_type'] == 'yesno':
-            obj['select_choices_or_calculations'] = '1, Yes | 0, No'
-        elif obj['field_type'] == 'truefalse':
-            obj['select_choices_or_calculations'] = '1, True | 0, False'
-        elif obj['field_type'] not in approved_field_types:
-            logging.info("Codebook: Invalid field type " + obj['field_type'] + ' ' + obj['field_name'])
-            continue
-        logging.info("Codebook: Validated " + obj['field_name'] + ' of type ' + obj['field_type'])
-
-        # Convert REDCap structure to dictionary structure
-        if obj['select_choices_or_calculations'] and ((obj['field_name'] in criteria) or (obj['field_name'] == treatment_field)):
-            try:
-                pipe_split = obj['select_choices_or_calculations'].split('|')
-                temp_dict = {}
-                for pair in pipe_split:
-                    kv_list = pair.split(',')
-                    temp_dict[kv_list[1].strip()] = kv_list[0].strip()
-                codebook[obj['field_name']] = temp_dict
-                print("Codebook: Succesfully converted " + obj['field_name'])
-                logging.info("Codebook: Succesfully converted " + obj['field_name'])
-            except Exception as e:
-                print("Codebook: Failed to convert " + obj['field_name'])
-                logging.info("Codebook: Failed to convert " + obj['field_name'])
-                print(e)
-                sys.exit(1)
+    codebook_df = pd.DataFrame(full_codebook, columns=['field_name', 'field_type', 'select_choices_or_calculations'])
+
+    # Check to make sure all criteria have label:value options.
+    # Current supported field types include Multiple Choice (dropdown),  Multiple Choice (radio),
+    # Checkboxes, Yes-No, and True-False.  Yes-No and True-False values are calculated within the code
+    approved_field_types = ['dropdown', 'radio', 'checkbox', 'yesno', 'truefalse']
+    codebook_df.loc[codebook_df['field_type'] == 'yesno', 'select_choices_or_calculations'] = '1, Yes | 0, No'
+    codebook_df.loc[codebook_df['field_type'] == 'truefalse', 'select_choices_or_calculations'] = '1, True | 0, False'
+    approved = codebook_df['field_type'].isin(approved_field_types)
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        for field_name, field_type, is_approved in zip(codebook_df['field_name'], codebook_df['field_type'], approved):
+            if is_approved:
+                logging.info("Codebook: Validated %s of type %s", field_name, field_type)
+            else:
+                logging.info("Codebook: Invalid field type %s %s", field_type, field_name)
+
+    # Convert REDCap structure to dictionary structure
+    selected = approved & (codebook_df['select_choices_or_calculations'].fillna('') != '') \
+        & (codebook_df['field_name'].isin(criteria) | (codebook_df['field_name'] == treatment_field))
+    if not selected.any():
+        return codebook
+    choices = codebook_df[selected].set_index('field_name')['select_choices_or_calculations']
+    pairs = choices.str.split('|').explode().str.split(',', expand=True).reindex(columns=[0, 1])
+    pairs = pd.DataFrame({'value': pairs[0].str.strip(), 'label': pairs[1].str.strip()})
+    for field_name, group in pairs.groupby(level=0, sort=False):
+        if group['label'].isna().any():
+            print("Codebook: Failed to convert " + field_name)
+            logging.info("Codebook: Failed to convert " + field_name)
+            print("Choice without a label in " + field_name)
+            sys.exit(1)
+        codebook[field_name] = dict(zip(group['label'], group['value']))
+        print("Codebook: Succesfully converted " + field_name)
+        logging.info("Codebook: Succesfully converted %s", field_name)
     return codebook
 
 def pull_allocation_table():
     # Read in allocation table (csv or excel file) from local data folder
-    filename = './data/' + allocation_tablename
     try:
-        temp_df = pd.read_csv(filename)
+        temp_df = pd.read_csv(allocation_filename)
     except:
         try:
-            temp_df = pd.read_excel(filename)
+            temp_df = pd.read_excel(allocation_filename)
         except Exception as e:
             print("Failed to read in " + allocation_tablename)
             logging.info("Failed to read in " + allocation_tablename)
@@ -120,51 +206,124 @@ def pull_allocation_table():
     logging.info("Successfully read in table " + allocation_tablename)
     return temp_df
     
+def probability_state_key(full_criteria, translation_dict):
+    # Probabilities depend only on the allocation table, the criteria pulled from the
+    # REDCap report, and the label:value translation from the codebook.  Hash all of
+    # them so a saved probability dictionary is reused only while none have changed.
+    key = hashlib.sha1()
+    with open(allocation_filename, 'rb') as f:
+        key.update(f.read())
+    key.update(orjson.dumps([full_criteria, translation_dict, treatment_field, randomized_field], option=orjson.OPT_SORT_KEYS))
+    return key.hexdigest()
+
+def load_probability_state(state_key):
+    # Return the probability dictionary saved by a previous run if it was built
+    # from the same inputs, otherwise None
+    try:
+        with open(probability_state_filename, 'rb') as f:
+            saved_key, probability_dict = pickle.load(f)
+    except Exception:
+        return None
+    if saved_key != state_key:
+        return None
+    print("Loaded probabilities from saved state")
+    logging.info("Loaded probabilities from saved state " + probability_state_filename)
+    return probability_dict
+
+def save_probability_state(probability_dict, state_key):
+    try:
+        write_cache_file(probability_state_filename, pickle.dumps((state_key, probability_dict)))
+    except Exception as e:
+        logging.info("Failed to save probability state")
+        logging.info(e)
+
 def calculate_probabilities(grouped_df, less_criteria):
     # Probabilities of a random treatment are calculated from frequency of that
     # treatment, given a specific set of criteria in the allocation table.
     #
     # a) grouped_df: dataframe containing the frequency of each criteria-treatment combination
-    # b) freq_df: dataframe containing the frequency of each criteria combination, irregardless of treatment
+    # b) criteria_totals: frequency of each criteria combination, irregardless of treatment,
+    #    broadcast back onto the matching rows of grouped_df
     # 
     # Probability for each criteria-treatment combination, given a set of criteria, is the quotient of a/b
 
-    mapped_df = pd.DataFrame() # Dataframe to hold probabilities of criteria-treatment combinations
-    freq_df = grouped_df.groupby(less_criteria, dropna=False, as_index=False)['size'].sum()
-    for index, row in freq_df.iterrows(): # Step through each criteria combination
-        for index2, row2 in grouped_df.iterrows(): # Step through each criteria-treatment combination
-            try:
-                if all(row[col] == row2[col] for col in less_criteria): # If criteria match then calculate probability
-                    temp_row = row2
-                    temp_row['probability'] = round(row2['size'] / (row['size']), 3)
-                    temp_df = pd.DataFrame([temp_row])
-                    mapped_df = pd.concat([mapped_df, temp_df], ignore_index=True)
-                else:
-                    pass
-            except Exception as e:
-                print("Failed to calculate probability on freq_df row " + row + " and grouped_df row " + row2)
-                logging.info("Failed to calculate probability on freq_df row " + row + " and grouped_df row " + row2)
-                logging.info(e)
-                sys.exit(1)
+    try:
+        criteria_totals = grouped_df.groupby(less_criteria, dropna=False, observed=True)['size'].transform('sum')
+        mapped_df = grouped_df.assign(probability=(grouped_df['size'] / criteria_totals).round(3))
+        # Counts and 3-place probabilities fit comfortably in 32-bit types
+        mapped_df['size'] = mapped_df['size'].astype(np.int32)
+        mapped_df['probability'] = mapped_df['probability'].astype(np.float32)
+    except Exception as e:
+        print("Failed to calculate probabilities")
+        logging.info("Failed to calculate probabilities")
+        logging.info(e)
+        sys.exit(1)
     print("Succesfully calculated probabilities")
     logging.info("Succesfully calculated probabilities")
     mapped_df[randomized_field] = mapped_df[treatment_field]
     return mapped_df
 
+def holds_values(column, label_dict):
+    # True when an allocation table column already stores codebook values rather
+    # than labels, in which case there is nothing to translate.  Blank cells are
+    # ignored so a column of values with some empty criteria is still recognized.
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.cat.categories.to_series()
+    column = column.astype(object)
+    values = column[column.notna() & (column != '')]
+    if values.empty:
+        return False
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.isna().any():
+        return False
+    try:
+        codebook_values = set(map(int, label_dict.values()))
+    except ValueError:
+        return False
+    return set(numbers.unique()).issubset(codebook_values)
+
 def convert_to_values(full_criteria, mapped_df, translation_dict):
     # Convert labels to values so they can match with the eligibility_report
     # created earlier from REDCap codebook
     for column_name in full_criteria:
         try:
-            mapped_df[column_name] = mapped_df[column_name].apply(lambda x: translation_dict[column_name].get(x, None))
+            if holds_values(mapped_df[column_name], translation_dict[column_name]):
+                continue
+            labels = mapped_df[column_name]
+            mapped_df[column_name] = labels.map(translation_dict[column_name])
         except Exception as e:
             print("Failed to convert " + column_name + " to value")
             logging.info("Failed to convert " + column_name + " to value")
             logging.info(e)
             sys.exit(1)
-    mapped_df.replace({pd.NA: '', np.nan: ''}, inplace=True)
+        # A column with entries that match no codebook label would otherwise become all -1
+        # and silently pool every stratum of that criterion together
+        if mapped_df[column_name].isna().all() and (labels.astype(object).fillna('') != '').any():
+            print("Failed to convert " + column_name + " to value: no entries match the codebook labels")
+            logging.info("Failed to convert " + column_name + " to value: no entries match the codebook labels")
+            sys.exit(1)
+    # Blank out unmatched labels.  Only columns with missing values are filled, since
+    # categorical criteria columns reject '' as a new category.
+    mapped_df = mapped_df.fillna({column_name: '' for column_name in mapped_df.columns[mapped_df.isna().any()]})
     return mapped_df
 
+def convert_to_integers(df, columns, source):
+    # Convert codebook values in the given columns to integers.  Empty cells become -1.
+    # Any other value that is not numeric (e.g. an alphanumeric choice code) stops the
+    # run, since treating it as empty would merge criteria or leave subjects unassigned.
+    for column_name in columns:
+        column = df[column_name].astype(object)
+        blank = column.isna() | (column == '')
+        numbers = pd.to_numeric(column.where(~blank), errors='coerce')
+        invalid = numbers.isna() & ~blank
+        if invalid.any():
+            invalid_values = ', '.join(sorted(str(value) for value in column[invalid].unique()))
+            print("Failed to convert " + column_name + " in " + source + " to integer values: " + invalid_values)
+            logging.info("Failed to convert " + column_name + " in " + source + " to integer values: " + invalid_values)
+            sys.exit(1)
+        df[column_name] = pd.to_numeric(numbers.fillna(-1), downcast='integer')
+    return df
+
 def create_probability_dict(mapped_df, less_criteria):
     # mapped_df is the dataframe containing probabilites of criteria-treatment combinations.
     # This function converts that dataframe into a dictionary where each key is a specific
@@ -178,32 +337,55 @@ def create_probability_dict(mapped_df, less_criteria):
     # (2, 1) : {1: 0.2, 2: 0.55, 3: 0.25}
     # (2, 2) : {1: 0.1, 2: 0.9}
 
+    # Pull each column out once as plain Python values rather than building a Series per row
+    keys = list(zip(*[mapped_df[column_name].tolist() for column_name in less_criteria]))  # Tuples of criteria values.  Become the keys in new dictionary.
+    treatments = mapped_df[randomized_field].tolist()  # Keys for the inner dictionaries are the values of treatment options.
+    probabilities = mapped_df['probability'].tolist()  # Values for the inner dictionaries are the probabilities of those treatments.
+
     probability_dict = {}
-    for index, row in mapped_df.iterrows():
-        key = tuple(row[less_criteria])  # Create a tuple of values from specified columns.  Becomes the key in new dictionary.
-        value_dict = probability_dict.get(key, {})  # Get the inner dictionary for that key, or create one if key doesn't exist.
-        inner_key = row[randomized_field]   # Key for the inner dictionary is the value of treatment option.
-        inner_value = row['probability']    # Value for the inner dictionary is the probability of that treatment.
-        value_dict[inner_key] = inner_value
-        probability_dict[key] = value_dict
+    for key, treatment, probability in zip(keys, treatments, probabilities):
+        probability_dict.setdefault(key, {})[treatment] = probability
     return probability_dict
 
-def randomization_step(eligibility_report, less_criteria, probability_dict):
-    # Each subject in eligibility_report is randomly assigned a treatment 
-    # from the probability dictionary given their criteria values.
-
-    for report_key, report_value in enumerate(eligibility_report):
-        if all(key in report_value for key in less_criteria):
-            tuple_key = tuple(report_value[key] for key in less_criteria)
-            if tuple_key in probability_dict:
-                multilevel_value = probability_dict[tuple_key]
-                random_choice = random.choices(list(multilevel_value.keys()), weights=list(multilevel_value.values()), k=1)[0]
-                eligibility_report[report_key][randomized_field] = random_choice
-    return eligibility_report
+def create_sampling_table(probability_dict):
+    # Precompute, for each criteria combination in probability_dict, an array of its
+    # treatment options and the running total of their probabilities.  A uniform draw
+    # scaled to the final total can then be located with a binary search.  Probabilities
+    # are rounded to 3 places and may not sum to exactly 1, which Generator.choice rejects.
+    #
+    # Example sampling table:
+    # (1, 2) : ([1, 2, 3], [0.33, 0.66, 1.0])
+
+    sampling_table = {}
+    for key, value_dict in probability_dict.items():
+        treatments = np.fromiter(value_dict.keys(), dtype=np.int32)
+        cumulative_weights = np.cumsum(np.fromiter(value_dict.values(), dtype=np.float32))
+        sampling_table[key] = (treatments, cumulative_weights)
+    return sampling_table
+
+def randomization_step(report_df, less_criteria, sampling_table):
+    # Each subject in report_df is randomly assigned a treatment 
+    # from the sampling table given their criteria values.
+
+    # Group subjects by criteria combination so each combination is sampled in one batch
+    subjects_by_key = {}
+    tuple_keys = zip(*[report_df[column_name].tolist() for column_name in less_criteria])
+    for position, tuple_key in enumerate(tuple_keys):
+        if tuple_key in sampling_table:
+            subjects_by_key.setdefault(tuple_key, []).append(position)
+
+    # Criteria columns are downcast to the smallest integer type, so widen before storing treatment values
+    randomized_values = report_df[randomized_field].to_numpy(dtype=np.int32, copy=True)
+    for tuple_key, positions in subjects_by_key.items():
+        treatments, cumulative_weights = sampling_table[tuple_key]
+        draws = rng.random(len(positions)) * cumulative_weights[-1]
+        randomized_values[positions] = treatments[np.searchsorted(cumulative_weights, draws, side='right')]
+    report_df[randomized_field] = randomized_values
+    return report_df
 
 def push_to_redcap(record_list):
         try:
-            import_json = json.dumps(record_list)
+            import_json = orjson.dumps(record_list).decode()
             logging.info("Succesfully serialized records to json")
         except Exception as e:
             logging.info("Failed to serialize records to json")
@@ -220,7 +402,13 @@ def push_to_redcap(record_list):
             'returnContent': 'count',
             'returnFormat': 'json'
         }
-        response = requests.post(redcap_endpoint,data=data)
+        try:
+            response = session.post(redcap_endpoint,data=data,timeout=import_timeout)
+        except Exception as e:
+            print("Failed to get a response to the records import. REDCap may still have imported them; check the project before rerunning.")
+            logging.info("Failed to get a response to the records import. Import outcome unknown.")
+            logging.info(e)
+            sys.exit(1)
         if response.status_code == 200:
             print('HTTP Status', str(response.status_code), response.reason, ": Records import successful")
             logging.info('HTTP Status:' + str(response.status_code) + ' ' + response.reason + ": Records import successful")
@@ -230,9 +418,18 @@ def push_to_redcap(record_list):
             sys.exit(1)
 
 def main():
-    # Pull reports from REDCap and create translation dictionary of labels to values
-    eligibility_report = pull_redcap_report()
-    original_codebook = pull_redcap_codebook()
+    # Pull reports from REDCap and the allocation table concurrently so the
+    # network round-trips and disk read overlap.  A sys.exit inside a worker
+    # is re-raised here by result().
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        report_future = executor.submit(pull_redcap_report)
+        codebook_future = executor.submit(pull_redcap_codebook)
+        allocation_future = executor.submit(pull_allocation_table)
+        eligibility_report = report_future.result()
+        original_codebook = codebook_future.result()
+        allocation_df = allocation_future.result()
+
+    # Select criteria from the REDCap report and create translation dictionary of labels to values
     try:
         full_criteria = list(eligibility_report[0].keys())[1:] # Create list of criteria variables from REDCap report
         print("Criteria selected from REDCap: " + ', '.join(full_criteria))
@@ -244,10 +441,7 @@ def main():
         sys.exit(1)
     translation_dict = convert_codebook(original_codebook, full_criteria) 
 
-    # Pull allocation table and count frequency of treatments by criteria
-    allocation_df = pull_allocation_table()
-    allocation_df.replace({pd.NA: '', np.nan: ''}, inplace=True)
-    grouped_df = allocation_df.groupby(allocation_df.columns.to_list(), as_index=False, dropna=False).size()
+    allocation_df = allocation_df.fillna('')
 
     # Create list of criteria without the randomized_field
     less_criteria = full_criteria.copy()
@@ -264,28 +458,47 @@ def main():
         print("Table criteria: " + ', '.join(sorted(allocation_df.columns.drop(treatment_field).to_list())))
         sys.exit(1)
 
-    # Calculate dataframe of criteria combinations and their probabilities
-    mapped_df = calculate_probabilities(grouped_df, less_criteria)
+    # Convert eligibility_report from records to columns so each later pass works on whole columns.
+    # Criteria values are converted from strings to the smallest integer type that fits them,
+    # or replaced with -1 if empty.
+    # The first column is the record id and is left untouched.
+    report_df = pd.DataFrame({key: [record.get(key, '') for record in eligibility_report] for key in eligibility_report[0]})
+    report_df = convert_to_integers(report_df, full_criteria, 'REDCap report')
 
-    # Replace labels with values in mapped_df so it can match eligibility_report.
-    mapped_df = convert_to_values(full_criteria, mapped_df, translation_dict)
-    mapped_df[full_criteria] = mapped_df[full_criteria].replace(['',np.inf, -np.inf], np.nan).fillna(-1).astype(int)
+    # Reuse the probabilities from a previous run when the allocation table, criteria and codebook are unchanged
+    state_key = probability_state_key(full_criteria, translation_dict)
+    probability_dict = load_probability_state(state_key)
+    if probability_dict is None:
+        # Count frequency of treatments by criteria in allocation table.  Criteria are cast to
+        # categoricals and pre-sorted so the groupby can work on sorted integer codes.
+        for column_name in less_criteria:
+            allocation_df[column_name] = allocation_df[column_name].astype('category')
+        grouped_df = allocation_df.sort_values(less_criteria).groupby(allocation_df.columns.to_list(), as_index=False, dropna=False, sort=False, observed=True).size()
 
-     # Convert values from strings to integers in eligibility_report, or replace with -1 if empty
-    eligibility_report = [{key: int(value) if value != '' else -1 for key, value in input_dict.items()} for input_dict in eligibility_report]
+        # Calculate dataframe of criteria combinations and their probabilities
+        mapped_df = calculate_probabilities(grouped_df, less_criteria)
 
-    # Create the multilevel dictionary to store probabilities
-    probability_dict = create_probability_dict(mapped_df, less_criteria)
+        # Replace labels with values in mapped_df so it can match eligibility_report.
+        mapped_df = convert_to_values(full_criteria, mapped_df, translation_dict)
+        mapped_df = convert_to_integers(mapped_df, full_criteria, 'allocation table')
+
+        # Create the multilevel dictionary to store probabilities
+        probability_dict = create_probability_dict(mapped_df, less_criteria)
+        save_probability_state(probability_dict, state_key)
+    sampling_table = create_sampling_table(probability_dict)
 
     # Assign appropriate treatments to randomized_field via probability distribution in probability_dict
-    eligibility_report = randomization_step(eligibility_report, less_criteria, probability_dict)
-
-    logging.info("Records to import...")
-    for record in eligibility_report:
-        for key, value in record.items():
-            if value == -1:
-                record[key] = None
-        logging.info(record)
+    report_df = randomization_step(report_df, less_criteria, sampling_table)
+
+    # Convert back to records for import, leaving fields that were empty as None
+    import_df = report_df.astype(object)
+    for column_name in full_criteria:
+        import_df[column_name] = np.where(report_df[column_name] == -1, None, import_df[column_name])
+    eligibility_report = import_df.to_dict(orient='records')
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Records to import...")
+        for record in eligibility_report:
+            logging.info("%s", record)
 
     # Push records back to REDCap via API
     push_to_redcap(eligibility_report)